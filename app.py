@@ -1,36 +1,75 @@
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, Text, DateTime, create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy import DateTime, bindparam
+from sqlalchemy import text as sql_text
+from database import engine, init_db
 from dotenv import load_dotenv
 from google import genai
+from google.genai.types import HttpOptions
+import httpx
 from datetime import datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+from contextlib import aclosing, asynccontextmanager, suppress
 import os
+from urllib.parse import urlsplit
 import asyncio
-from tenacity import retry, wait_fixed, stop_after_attempt
-from google.genai.errors import ServerError
+import logging
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception
+from google.genai.errors import ClientError, ServerError
+from concurrent.futures import ThreadPoolExecutor
 
 # -----------------------
 # Configuración FastAPI
 # -----------------------
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
-client = genai.Client(api_key=api_key)
+GENAI_MAX_WORKERS = 32
+
+# Un solo client por proceso: su httpx.Client mantiene las conexiones TLS
+# abiertas (keep-alive + HTTP/2) y se reutilizan entre requests
+client = genai.Client(
+    api_key=api_key,
+    http_options=HttpOptions(
+        timeout=30_000,  # ms
+        client_args={
+            "http2": True,
+            "limits": httpx.Limits(
+                max_keepalive_connections=GENAI_MAX_WORKERS,
+                keepalive_expiry=60,
+            ),
+        },
+    ),
+)
 
 # -----------------------
 # CORS
 # -----------------------
+def as_origin(url):
+    # El navegador manda Origin como esquema + host + puerto, sin path; si
+    # FRONTEND_URL trae path (p. ej. la URL de GitHub Pages con el repo) se
+    # recorta, porque si no nunca coincide y se bloquea al frontend
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        raise ValueError(f"FRONTEND_URL no es una URL válida: {url!r}")
+    origin = f"{parts.scheme}://{parts.netloc}"
+    if origin != url.rstrip("/"):
+        logger.warning("FRONTEND_URL %r trae path; se usa el origin %r", url, origin)
+    return origin
+
 origins = [
     "http://localhost",
-    "http://localhost:5174/chatbot.github.io/",
-    os.getenv("FRONTEND_URL", "http://localhost:5174")
+    "http://localhost:5174",  # frontend en desarrollo
+    as_origin(os.getenv("FRONTEND_URL", "http://localhost:5174")),
 ]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -39,30 +78,23 @@ app.add_middleware(
 # -----------------------
 # SQLAlchemy
 # -----------------------
-Base = declarative_base()
-DB_URL = "sqlite:///chat_history.db"
-engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
-
-class Interaction(Base):
-    __tablename__ = "interactions"
-    id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    session_id = Column(String, index=True)
-    personaje = Column(String)
-    user_message = Column(Text)
-    assistant_reply = Column(Text)
-    tokens_used = Column(Integer)
-
-Base.metadata.create_all(bind=engine)
-
-# Dependency para sesiones DB
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# INIT_DB=1 crea el esquema al importar la app (lo normal es
+# python -m scripts.init_db una vez por deploy)
+if os.getenv("INIT_DB"):
+    init_db()
+
+# Insert directo, sin pasar por el unit-of-work del ORM; Interaction (en
+# database.py) solo define el esquema
+INSERT_INTERACTION = sql_text(
+    "INSERT INTO interactions"
+    " (session_id, personaje, user_message, assistant_reply, tokens_used, timestamp)"
+    " VALUES (:session_id, :personaje, :user_message, :assistant_reply, :tokens_used, :timestamp)"
+).bindparams(bindparam("timestamp", type_=DateTime))
+
+# Escritura síncrona de un lote, se ejecuta fuera del event loop
+def _persist_batch(rows):
+    with engine.begin() as conn:
+        conn.execute(INSERT_INTERACTION, rows)
 
 # -----------------------
 # Modelo de request
@@ -76,22 +108,133 @@ class ChatRequest(BaseModel):
 # -----------------------
 # Historial en RAM
 # -----------------------
-conversations = {}
+MAX_SESSIONS = 10_000
+MAX_TURNS = 10  # pares usuario/asistente que se conservan por sesión
+
+class LRU(OrderedDict):
+    """Dict acotado que descarta la sesión usada hace más tiempo."""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+conversations = LRU(maxsize=MAX_SESSIONS)
+
+# -----------------------
+# Escritor en segundo plano
+# -----------------------
+FLUSH_MAX_ROWS = 100
+FLUSH_INTERVAL = 0.05  # segundos
+_FLUSH_STOP = object()
+
+async def flusher(write_q):
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await write_q.get()
+        if item is _FLUSH_STOP:
+            break
+        rows = [item]
+        # Junta hasta FLUSH_MAX_ROWS filas o FLUSH_INTERVAL segundos por commit
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(rows) < FLUSH_MAX_ROWS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(write_q.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _FLUSH_STOP:
+                # Se guarda el lote que ya se tiene en mano antes de salir
+                stopping = True
+                break
+            rows.append(item)
+        try:
+            await asyncio.to_thread(_persist_batch, rows)
+        except Exception:
+            logger.exception("No se pudieron guardar %d interacciones", len(rows))
+
+@app.on_event("startup")
+async def start_flusher():
+    # La cola se crea aquí para que quede ligada al loop que corre la app
+    app.state.write_q = asyncio.Queue()
+    app.state.flusher = asyncio.create_task(flusher(app.state.write_q))
+
+@app.on_event("shutdown")
+async def stop_flusher():
+    # El sentinel va al final de la cola: el flusher guarda todo lo anterior
+    # (incluido el lote en curso) y termina solo
+    write_q = app.state.write_q
+    write_q.put_nowait(_FLUSH_STOP)
+    await app.state.flusher
+
+    # Guarda lo que se haya encolado después del sentinel
+    rows = []
+    while not write_q.empty():
+        rows.append(write_q.get_nowait())
+    if rows:
+        await asyncio.to_thread(_persist_batch, rows)
 
 # -----------------------
 # System prompt
 # -----------------------
 SYSTEM_PROMPT = """..."""  # manten tu prompt original
 
+# El personaje/description casi nunca cambia dentro de una sesión,
+# así que el prompt formateado se reutiliza entre requests
+@lru_cache(maxsize=512)
+def build_system(personaje, description):
+    return SYSTEM_PROMPT.format(personaje=personaje, description=description)
+
 # -----------------------
 # Función async para llamar a Gemini con retry
 # -----------------------
-@retry(wait=wait_fixed(2), stop=stop_after_attempt(3), retry=(lambda e: isinstance(e, ServerError)))
+_STREAM_END = object()
+
+# Pool propio y acotado para las llamadas bloqueantes a Gemini, así una
+# ráfaga de requests no dispara threads sin límite
+@app.on_event("startup")
+async def start_genai_executor():
+    app.state.genai_executor = ThreadPoolExecutor(
+        max_workers=GENAI_MAX_WORKERS, thread_name_prefix="genai"
+    )
+
+@app.on_event("shutdown")
+async def stop_genai_executor():
+    app.state.genai_executor.shutdown(wait=False, cancel_futures=True)
+
+def is_overloaded(exc):
+    # 5xx o 429: el modelo está saturado y vale la pena reintentar
+    return isinstance(exc, ServerError) or (isinstance(exc, ClientError) and exc.code == 429)
+
+# Backoff exponencial con jitter para que los clientes no reintenten sincronizados
+genai_retry = retry(
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(is_overloaded),
+    reraise=True,
+)
+
+@genai_retry
 async def call_genai_async(contents):
-    loop = asyncio.get_event_loop()
-    # Ejecuta la llamada síncrona de Gemini en un thread para no bloquear
+    # Ejecuta la llamada síncrona de Gemini en el pool para no bloquear
+    # el event loop mientras dura el round-trip al modelo
+    loop = asyncio.get_running_loop()
     response = await loop.run_in_executor(
-        None,
+        app.state.genai_executor,
         lambda: client.models.generate_content(
             model="gemini-1.5-flash",
             contents=contents
@@ -99,54 +242,203 @@ async def call_genai_async(contents):
     )
     return response
 
+@genai_retry
+async def _open_genai_stream(contents):
+    # El request HTTP sale con el primer next(), así que el retry cubre
+    # abrir el stream y recibir el primer chunk; a media respuesta ya no
+    # se reintenta porque el cliente ya recibió parte del texto
+    loop = asyncio.get_running_loop()
+    executor = app.state.genai_executor
+    stream = await loop.run_in_executor(
+        executor,
+        lambda: client.models.generate_content_stream(
+            model="gemini-1.5-flash",
+            contents=contents
+        )
+    )
+    first = await loop.run_in_executor(executor, next, stream, _STREAM_END)
+    return stream, first
+
+async def stream_genai_async(contents):
+    # Cada next() del stream bloquea hasta que llega el siguiente chunk,
+    # así que también se ejecuta en el pool
+    loop = asyncio.get_running_loop()
+    executor = app.state.genai_executor
+    stream, chunk = await _open_genai_stream(contents)
+    try:
+        while chunk is not _STREAM_END:
+            yield chunk
+            chunk = await loop.run_in_executor(executor, next, stream, _STREAM_END)
+    finally:
+        # Si el cliente se desconecta, cierra el stream y su conexión HTTP.
+        # Si un next() sigue corriendo en el pool, close() no puede
+        # interrumpirlo; el generador se cierra cuando se libere
+        with suppress(ValueError):
+            stream.close()
+
 # -----------------------
-# Endpoint Chat
+# Helpers del endpoint
 # -----------------------
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
-    if not request.session_id.strip() or not request.message.strip():
-        return {"error": "session_id y message son obligatorios"}
+SATURATED_REPLY = "El modelo está saturado 😅, intenta de nuevo en unos segundos."
 
-    # Cargar historial en RAM
-    history = conversations.get(request.session_id, [])
+# session_id -> [lock, requests usándolo]; la entrada se borra cuando nadie
+# la usa, así que solo hay locks para sesiones con requests en curso
+session_locks = {}
 
-    # Construir contenido para Gemini
-    contents = [SYSTEM_PROMPT.format(
-        personaje=request.personaje,
-        description=request.description
-    )]
-    for msg in history:
-        contents.append(f"{msg['role']}: {msg['content']}")
-    contents.append(f"Usuario: {request.message}\nAsistente:")
-
-    # Llamada a Gemini con manejo de errores
+@asynccontextmanager
+async def session_lock(session_id):
+    # Serializa leer historial -> llamar a Gemini -> guardar turno por sesión
+    entry = session_locks.setdefault(session_id, [asyncio.Lock(), 0])
+    entry[1] += 1
     try:
-        response = await call_genai_async(contents)
-        text = response.text
-        tokens = response.usage_metadata.total_token_count
-    except ServerError:
-        text = "El modelo está saturado 😅, intenta de nuevo en unos segundos."
-        tokens = 0
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del session_locks[session_id]
+
+SELECT_RECENT_TURNS = sql_text(
+    "SELECT user_message, assistant_reply FROM interactions"
+    " WHERE session_id = :session_id"
+    " ORDER BY timestamp DESC LIMIT :limit"
+)
+
+def _fetch_recent_turns(session_id):
+    with engine.connect() as conn:
+        rows = conn.execute(
+            SELECT_RECENT_TURNS, {"session_id": session_id, "limit": MAX_TURNS}
+        ).all()
+    return rows[::-1]
+
+async def load_history(session_id):
+    # Ventana deslizante: al pasar de MAX_TURNS se caen los turnos más viejos
+    history = conversations.get(session_id)
+    if history is None:
+        # Sesión fría (reinicio o desalojada del LRU): se hidrata desde SQLite
+        history = deque(maxlen=2 * MAX_TURNS)
+        for user_message, assistant_reply in await asyncio.to_thread(_fetch_recent_turns, session_id):
+            history.append(f"Usuario: {user_message}")
+            history.append(f"Asistente: {assistant_reply}")
+        conversations[session_id] = history
+    return history
 
+PROMPT_TOKEN_BUDGET = 4000
+KEEP_LAST_TURNS = 2  # pares que se mandan siempre, aunque pasen el presupuesto
+
+def estimate_tokens(text):
+    # Aproximación barata: ~4 caracteres por token
+    return len(text) // 4
+
+def build_contents(request, history):
+    system = build_system(request.personaje, request.description)
+    current = f"Usuario: {request.message}\nAsistente:"
+    # El historial ya guarda cada mensaje como línea del prompt
+    lines = list(history)
+
+    # Se recorre de lo más nuevo a lo más viejo por pares usuario/asistente
+    # y se descartan los turnos más viejos que ya no caben en el presupuesto
+    budget = PROMPT_TOKEN_BUDGET - estimate_tokens(system) - estimate_tokens(current)
+    keep_from = len(lines) - 2 * KEEP_LAST_TURNS
+    start = len(lines)
+    while start >= 2:
+        cost = estimate_tokens(lines[start - 2]) + estimate_tokens(lines[start - 1])
+        if cost > budget and start <= keep_from:
+            break
+        budget -= cost
+        start -= 2
+
+    return "\n".join([system, *lines[start:], current])
+
+def save_turn(request, history, text, tokens):
     # Guardar en RAM
-    history.append({"role": "user", "content": request.message})
-    history.append({"role": "assistant", "content": text})
+    history.append(f"Usuario: {request.message}")
+    history.append(f"Asistente: {text}")
     conversations[request.session_id] = history
 
     # Guardar en SQLite solo si hubo éxito
     if tokens > 0:
-        interaction = Interaction(
+        app.state.write_q.put_nowait(dict(
+            timestamp=datetime.utcnow(),
             session_id=request.session_id,
             personaje=request.personaje,
             user_message=request.message,
             assistant_reply=text,
             tokens_used=tokens
-        )
-        db.add(interaction)
-        db.commit()
+        ))
+
+# -----------------------
+# Endpoint Chat
+# -----------------------
+@app.post("/chat")
+async def chat_endpoint(request: ChatRequest):
+    if not request.session_id.strip() or not request.message.strip():
+        return {"error": "session_id y message son obligatorios"}
+
+    async with session_lock(request.session_id):
+        # Cargar historial en RAM
+        history = await load_history(request.session_id)
+
+        # Construir contenido para Gemini
+        contents = build_contents(request, history)
+
+        # Llamada a Gemini con manejo de errores
+        try:
+            response = await call_genai_async(contents)
+            text = response.text
+            tokens = response.usage_metadata.total_token_count
+        except (ServerError, ClientError) as e:
+            if not is_overloaded(e):
+                raise
+            text = SATURATED_REPLY
+            tokens = 0
+
+        save_turn(request, history, text, tokens)
 
     return {
         "reply": text,
         "tokens_used": tokens,
         "history_len": len(history)
     }
+
+# -----------------------
+# Endpoint Chat en streaming
+# -----------------------
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    if not request.session_id.strip() or not request.message.strip():
+        return {"error": "session_id y message son obligatorios"}
+
+    async def gen():
+        async with session_lock(request.session_id):
+            history = await load_history(request.session_id)
+            contents = build_contents(request, history)
+
+            parts = []
+            tokens = 0
+            complete = True
+            try:
+                # aclosing: si el cliente corta, el stream de Gemini se cierra ya
+                async with aclosing(stream_genai_async(contents)) as chunks:
+                    async for chunk in chunks:
+                        if chunk.text:
+                            parts.append(chunk.text)
+                            yield chunk.text
+                        if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                            tokens = chunk.usage_metadata.total_token_count
+            except (ServerError, ClientError) as e:
+                if not is_overloaded(e):
+                    raise
+                if parts:
+                    # Respuesta cortada a la mitad: no entra al historial
+                    complete = False
+                else:
+                    parts.append(SATURATED_REPLY)
+                    yield SATURATED_REPLY
+                tokens = 0
+
+            # La respuesta completa se junta en memoria para el historial y la DB
+            if complete:
+                save_turn(request, history, "".join(parts), tokens)
+
+    return StreamingResponse(gen(), media_type="text/plain")
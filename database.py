@@ -1,10 +1,50 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base 
-from sqlalchemy.orm import sessionmaker 
+from sqlalchemy import Column, Integer, String, Text, DateTime, create_engine, event, Index
+from sqlalchemy import text as sql_text
+from sqlalchemy.orm import declarative_base
+from datetime import datetime
 
-DATABASE_URL = "sqlite:///./chatbot.db"
+# -----------------------
+# SQLAlchemy
+# -----------------------
+# Sin dependencias de FastAPI ni de Gemini, para que scripts/init_db.py
+# pueda crear el esquema sin levantar la app
+Base = declarative_base()
+DB_URL = "sqlite:///chat_history.db"
+engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# WAL permite lectores concurrentes con un escritor y reduce los fsync por commit
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
-Base = declarative_base()
\ No newline at end of file
+class Interaction(Base):
+    __tablename__ = "interactions"
+    id = Column(Integer, primary_key=True, index=True)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    session_id = Column(String)
+    personaje = Column(String)
+    user_message = Column(Text)
+    assistant_reply = Column(Text)
+    tokens_used = Column(Integer)
+
+# "Últimos N mensajes de una sesión" se resuelve con un seek + range scan,
+# sin sort; cubre también las búsquedas solo por session_id
+Index("ix_inter_sess_ts", Interaction.session_id, Interaction.timestamp.desc())
+
+# El esquema se crea una vez por deploy (python -m scripts.init_db), no en
+# cada arranque de worker
+def init_db():
+    Base.metadata.create_all(bind=engine)
+
+    # create_all no toca tablas que ya existen: migra los índices a mano
+    with engine.begin() as conn:
+        conn.execute(sql_text("DROP INDEX IF EXISTS ix_interactions_session_id"))
+        conn.execute(sql_text(
+            "CREATE INDEX IF NOT EXISTS ix_inter_sess_ts"
+            " ON interactions (session_id, timestamp DESC)"
+        ))
@@ -0,0 +1,9 @@
+# -----------------------
+# Crea las tablas e índices de SQLite
+# Uso (desde la raíz del proyecto): python -m scripts.init_db
+# -----------------------
+from database import init_db
+
+if __name__ == "__main__":
+    init_db()
+    print("Esquema listo")